@@ -3,37 +3,52 @@ from tiger_bridge import TSPro
 import signal
 import sys
 import os
+import queue
+import threading
+
+# error names looked up once here, rather than constructing an ERROR_CODES member for every received error
+_ERROR_NAMES = {error.value: error.name for error in TSPro.ERROR_CODES}
+
+# the event handlers run on TSPro's socket read thread, so they queue their output here
+# instead of printing, and the print thread does the slow terminal writes
+_print_queue = queue.SimpleQueue()
+
+def print_queue_loop():
+    while True:
+        sys.stdout.write(_print_queue.get())
+        sys.stdout.flush()
 
 def move_finished_handler():
-    print("\nmove finished!")
+    _print_queue.put_nowait("\nmove finished!\n")
 
-def received_position_handler(*arg: tuple[str]):
-    position = float(arg[0])
-    print(f"\nreceived a position: {position}")
+def received_position_handler(position_str: str):
+    position = float(position_str)
+    _print_queue.put_nowait(f"\nreceived a position: {position}\n")
 
-def error_handler(*arg: tuple[str]):
-    error_code = int(arg[0])
-    print(f"received an error {TSPro.ERROR_CODES(error_code).name}")
+def error_handler(error_code_str: str):
+    error_code = int(error_code_str)
+    _print_queue.put_nowait(f"received an error {_ERROR_NAMES.get(error_code, error_code)}\n")
 
 def tool_down_handler():
-    print("tool down")
+    _print_queue.put_nowait("tool down\n")
 
 def tool_up_handler():
-    print("tool UP")
+    _print_queue.put_nowait("tool UP\n")
 
 def get_setting_handler(*arg: tuple[str]):
-    print("received setting:", arg)
+    _print_queue.put_nowait(f"received setting: {arg}\n")
 
 def edge_detect_sensor_activated_handler():
-    print("edge detect sensor activated")
+    _print_queue.put_nowait("edge detect sensor activated\n")
 
 def edge_detect_sensor_deactivated_handler():
-    print("edge detect sensor deactivated")
+    _print_queue.put_nowait("edge detect sensor deactivated\n")
 
 def defect_sensor_activated_handler():
-    print("defect sensor activated")
+    _print_queue.put_nowait("defect sensor activated\n")
 
 def disconnection_handler():
+    # printed directly, since the process exits before the print thread would get to it
     print("socket connection lost. exiting...")
     os._exit(1)
 
@@ -49,59 +64,83 @@ Here's a list of valid commands:
     - cycle_tool
     """)
 
-def parse_command(tsp: TSPro, command: str):
-    segments = command.split(" ")
-    command_id = segments[0]
-
-    if command_id == "move_to":
-        position = segments[1]
-
-        try:
-            position = float(position)
-            tsp.request_move_to_position(position)
-        except ValueError:
-            print_help()
-            return
-    elif command_id == "stop":
-        tsp.request_stop()
-    elif command_id == "get_position":
-        tsp.request_current_position()
-    elif command_id == "exit":
-        os._exit(1)
-    elif command_id == "home":
-        tsp.request_home()
-    elif command_id == "calibrate":
-        if len(segments) < 2:
-            print("no position value provided")
-            return
-        
-        position = segments[1]
-
-        try:
-            position = float(position)
-            tsp.request_calibrate(position)
-        except ValueError:
-            print_help()
-            return
-    elif command_id == "get_setting":
-        if len(segments) < 2:
-            print("no setting name provided")
-            return
-        
-        setting_name = segments[1]
-        tsp.request_setting(setting_name)
-    elif command_id == "cycle_tool":
-        tsp.request_cycle_tool()
-    else:
+def move_to_command(tsp: TSPro, arg: str):
+    if not arg:
+        print("no position value provided")
+        return
+
+    try:
+        position = float(arg)
+    except ValueError:
         print_help()
         return
 
+    tsp.request_move_to_position(position)
+
+def calibrate_command(tsp: TSPro, arg: str):
+    if not arg:
+        print("no position value provided")
+        return
+
+    try:
+        position = float(arg)
+    except ValueError:
+        print_help()
+        return
+
+    tsp.request_calibrate(position)
+
+def get_setting_command(tsp: TSPro, arg: str):
+    if not arg:
+        print("no setting name provided")
+        return
+
+    tsp.request_setting(arg)
+
+def exit_command(tsp: TSPro, arg: str):
+    # disconnect stops the socket read thread, so the interpreter can shut down normally
+    tsp.disconnect()
+    sys.exit()
+
+def unknown_command(tsp: TSPro, arg: str):
+    print_help()
+
+# maps each command name to a function taking (tsp, arg) that validates its own arguments,
+# listed roughly in order of how often each command is used
+_COMMAND_TABLE = {
+    "move_to":      move_to_command,
+    "get_position": lambda tsp, arg: tsp.request_current_position(),
+    "stop":         lambda tsp, arg: tsp.request_stop(),
+    "home":         lambda tsp, arg: tsp.request_home(),
+    "calibrate":    calibrate_command,
+    "get_setting":  get_setting_command,
+    "cycle_tool":   lambda tsp, arg: tsp.request_cycle_tool(),
+    "exit":         exit_command,
+}
+
+def parse_command(tsp: TSPro, command: str):
+    # arg is the first space-separated word after the command, or an empty string if no argument was given.
+    # anything after that word is ignored, so "get_setting minlim extra" still only sends "minlim".
+    command_id, _, rest = command.strip().partition(" ")
+    arg, _, _ = rest.partition(" ")
+
+    # unknown commands, typos included, cost the same single hash lookup as valid ones
+    _COMMAND_TABLE.get(command_id, unknown_command)(tsp, arg)
+
+def command_loop(tsp: TSPro):
+    # bind these to locals once, so each loop iteration doesn't have to look them up as globals
+    _input, _parse_command = input, parse_command
+
+    while True:
+        _parse_command(tsp, _input("Enter a command: "))
 
 def main():
     print("Welcome to the TigerBridge command-line interface example. Press Ctrl+C at any point to exit.")
     tsp = TSPro()
     ip = ""
 
+    threading.Thread(target = print_queue_loop, daemon = True).start()
+
     if len(sys.argv) >= 2:
         ip = sys.argv[1] 
     else:
@@ -118,8 +157,8 @@ def main():
             break
 
     tsp.set_event_hook(TSPro.EVENT_CODES.MOVE_FINISHED, move_finished_handler)
-    tsp.set_event_hook(TSPro.EVENT_CODES.RECEIVED_POSITION, received_position_handler)
-    tsp.set_event_hook(TSPro.EVENT_CODES.ERROR, error_handler)
+    tsp.set_event_hook(TSPro.EVENT_CODES.RECEIVED_POSITION, received_position_handler, nargs = 1)
+    tsp.set_event_hook(TSPro.EVENT_CODES.ERROR, error_handler, nargs = 1)
     tsp.set_event_hook(TSPro.EVENT_CODES.TOOL_DISENGAGED, tool_up_handler)
     tsp.set_event_hook(TSPro.EVENT_CODES.TOOL_ENGAGED, tool_down_handler)
     tsp.set_event_hook(TSPro.EVENT_CODES.EDGE_DETECT_SENSOR_ACTIVATED, edge_detect_sensor_activated_handler)
@@ -127,8 +166,7 @@ def main():
     tsp.set_event_hook(TSPro.EVENT_CODES.DEFECT_SENSOR_ACTIVATED, defect_sensor_activated_handler)
     tsp.set_event_hook(TSPro.EVENT_CODES.DISCONNECTED, disconnection_handler)
 
-    while True:
-        parse_command(tsp, input("Enter a command: "))
+    command_loop(tsp)
 
 if __name__ == "__main__":
     # set the SIGINT handler back to the kernel default
@@ -1,8 +1,8 @@
 import socket
 import threading
-import select
+import selectors
 
-from types import FunctionType
+from collections.abc import Callable
 from enum import IntEnum, StrEnum
 
 PORT = 7071
@@ -80,102 +80,322 @@ class TSPro:
         HOME             = "home"
         CYCLE_TOOL       = "cycle_tool"
 
+    # every instance attribute is listed here, so instances don't need a __dict__ and attribute access is a fixed offset.
+    # the names are mangled to _TSPro__... just like the attributes themselves.
+    __slots__ = (
+        "__movement_in_progress",
+        "__connected",
+        "__read_buffer",
+        "__event_dict",
+        "__event_dict_mutex",
+        "__socket",
+        "__rx_buffer",
+        "__rx_view",
+        "__tx_buffer",
+        "__tx_mutex",
+        "__verbose",
+        "__socket_read_thread",
+        "__socket_read_stopped",
+        "__selector",
+        "__shutdown_receiver",
+        "__shutdown_sender",
+    )
+
     __delim_char           = "|"
-    __movement_in_progress = False
-    __connected            = False
-    __read_buffer: list    = []
-    __event_dict           = {}
-    __event_dict_mutex     = threading.Lock()
+    __delim_bytes          = __delim_char.encode()
+    # message prefixes never change, so they are encoded once here instead of on every send
+    __prefix_bytes         = {prefix: prefix.value.encode() for prefix in MESSAGE_REQUEST_PREFIXES}
+    # requests without arguments are always the same bytes, so they skip __format_message entirely
+    __stop_message         = b"stop\n"
+    __get_position_message = b"get_position\n"
+    __home_message         = b"home\n"
+    __cycle_tool_message   = b"cycle_tool\n"
+    __movement_in_progress: bool
+    __connected: bool
+    __read_buffer: list
+    __event_dict: dict
+    __event_dict_mutex: threading.Lock
     __socket: socket.socket
-    __socket_read_thread: threading.Thread
+    __rx_buffer: bytearray
+    __rx_view: memoryview
+    __tx_buffer: bytearray
+    __tx_mutex: threading.Lock
+    __verbose: bool
+    __socket_read_thread: threading.Thread | None
+    __socket_read_stopped: threading.Event
+    __selector: selectors.BaseSelector
+    __shutdown_receiver: socket.socket
+    __shutdown_sender: socket.socket
     __version: str         = "dev1.1.1.1"
 
-    def __init__(self):
+    def __init__(self, verbose: bool = False):
+        """
+        @param verbose bool: print every message sent and received.
+            Off by default, because the received messages are printed on the socket read thread,
+            which then has to wait for the terminal before it can handle the next message.
+        """
+
+        self.__verbose = verbose
+
+        # per-connection state lives on the instance so separate TSPro objects don't share hooks or buffers
+        self.__movement_in_progress = False
+        self.__connected            = False
+        self.__read_buffer          = []
+        self.__event_dict           = {}
+        self.__event_dict_mutex     = threading.Lock()
+
+        # received bytes are read straight into this buffer and reused for the lifetime of the object
+        self.__rx_buffer = bytearray(65536)
+        self.__rx_view   = memoryview(self.__rx_buffer)
+
+        # formatted requests are built in this buffer instead of a new bytes object per send
+        self.__tx_buffer = bytearray()
+        self.__tx_mutex  = threading.Lock()
+
+        # the socket read thread waits on both the TigerStop socket and __shutdown_receiver,
+        # so disconnect can wake it by sending a byte to __shutdown_sender.
+        # a socketpair is used rather than os.pipe because select on Windows only works with sockets.
+        self.__shutdown_receiver, self.__shutdown_sender = socket.socketpair()
+        self.__shutdown_receiver.setblocking(False)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__shutdown_receiver, selectors.EVENT_READ)
+
+        # set whenever no socket read thread is using the selector or rx buffer,
+        # i.e. before the first connect and once a read thread has finished its cleanup
+        self.__socket_read_stopped = threading.Event()
+        self.__socket_read_stopped.set()
+
+        self.__socket_read_thread = None
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.setblocking(True)
 
     def __del__(self):
+        # the socket read thread holds a reference to this object, so by the time this runs it has already exited
         if self.__socket != None:
             self.__socket.close()
 
-    def __parse_line(self, line: str) -> list[str]:
-        """
-        Decode a bytearray and split it using the internal delimiter character
+        self.__selector.close()
+        self.__shutdown_receiver.close()
+        self.__shutdown_sender.close()
 
-        @return list[str]
+    def __clear_shutdown_requests(self):
+        """
+        Discard any wake-up bytes left in __shutdown_receiver, e.g. from a disconnect
+        that raced with the connection being lost.
         """
 
-        return line.split(self.__delim_char)
+        try:
+            while self.__shutdown_receiver.recv(64):
+                pass
+        except BlockingIOError:
+            pass
 
-    def __format_message(self, *args: any) -> bytes:
+    def __format_message(self, prefix: MESSAGE_REQUEST_PREFIXES, *args: any) -> bytearray:
         """
-        Join all provided arguments into a string using the internal delimiter character and appended with a newline,
-        then return this message encoded as a bytes object.
+        Join the pre-encoded prefix and all provided arguments using the internal delimiter character,
+        appended with a newline, into __tx_buffer.
+        The returned buffer is overwritten by the next call, so callers must hold __tx_mutex until it has been sent.
 
-        @param args tuple[any]: data to include in the message
-        @return bytes
+        @param prefix MESSAGE_REQUEST_PREFIXES: the type of message being sent
+        @param args tuple[any]: data to include in the message, bytes are used as-is and anything else is converted to a string
+        @return bytearray
         """
 
-        # convert all arguments to strings,
-        # then concatenate all those strings with "|" between each one,
-        # and finally, append a newline.
-        message = self.__delim_char.join(map(str, args)) + "\n"
-        return message.encode()
+        buffer = self.__tx_buffer
+        buffer.clear()
+        buffer += self.__prefix_bytes[prefix]
 
-    def __send_formatted_message(self, *args: any):
+        # write "|" and then each argument after the prefix, and finally, append a newline.
+        for arg in args:
+            buffer += self.__delim_bytes
+            buffer += arg if isinstance(arg, (bytes, bytearray)) else str(arg).encode()
+
+        buffer += b"\n"
+        return buffer
+
+    def __send_formatted_message(self, prefix: MESSAGE_REQUEST_PREFIXES, *args: any):
         """
         Send a message over the socket that has been formatted using __format_message.
         """
 
-        message = self.__format_message(*args)
-        print(f"sending message {message}")
+        # event hooks run on the socket read thread and may send requests too, so __tx_buffer is shared between threads
+        with self.__tx_mutex:
+            self.__send_message(self.__format_message(prefix, *args))
 
-        try:
-            self.__socket.send(message)
-        except socket.error:
-            raise
+    def __send_message(self, message: bytes | bytearray):
+        """
+        Send an already formatted message over the socket.
+        """
+
+        if self.__verbose:
+            print(f"sending message {bytes(message)}")
+
+        # sendall keeps sending until the whole message is written, unlike send
+        self.__socket.sendall(message)
 
     def __socket_read(self, connection: socket.socket):
         """
         The function body for this class's socket reading thread.
+        Only this thread touches __rx_buffer once connect has started it.
+
+        @param connection socket.socket: the socket this thread reads from.
+            It's passed in rather than read from self.__socket,
+            so cleanup never touches a socket that a later connect has swapped in.
         """
 
-        while True:
-            line = self.__socket.makefile().readline()
-            print(f"received message: {line}")
+        selector          = self.__selector
+        shutdown_receiver = self.__shutdown_receiver
+        rx_buffer         = self.__rx_buffer
+        rx_view           = self.__rx_view
+        delim_char        = self.__delim_char
+        delim_bytes       = self.__delim_bytes
+        verbose           = self.__verbose
 
-            if line == "":
-                self.__connected = False
+        # True when disconnect asked this thread to stop, rather than the connection being lost
+        shutdown_requested = False
 
-                if TSPro.EVENT_CODES.DISCONNECTED in self.__event_dict and callable(self.__event_dict[TSPro.EVENT_CODES.DISCONNECTED]):
-                    self.__event_dict[TSPro.EVENT_CODES.DISCONNECTED]()
+        # number of bytes at the front of rx_buffer belonging to a line that hasn't been terminated yet
+        fill = 0
 
-                return
+        # True while skipping the rest of a line that was too long to fit in rx_buffer
+        discarding = False
+
+        # the cleanup in finally also runs if an event hook raises, so the connection is never left marked as connected
+        try:
+            while True:
+                # a single line filled the whole buffer without a newline, so it can't be a valid message.
+                # the rest of it is skipped up to the next newline, so its tail isn't parsed as a message of its own.
+                if fill == len(rx_buffer):
+                    fill = 0
+                    discarding = True
+
+                # wait until either the TigerStop sends something or disconnect is called
+                ready = [key.fileobj for key, _ in selector.select()]
+
+                if shutdown_receiver in ready:
+                    shutdown_requested = True
+                    break
+
+                try:
+                    received = connection.recv_into(rx_view[fill:])
+                except OSError:
+                    # e.g. the connection was reset, which is handled the same as the peer closing it
+                    received = 0
+
+                # recv_into returns 0 once the peer has closed the connection
+                if received == 0:
+                    break
+
+                end   = fill + received
+                start = 0
+                events = []
+
+                # the bytes before fill were already searched, so look for newlines only in what was just received
+                newline = rx_buffer.find(b"\n", fill, end)
+
+                if discarding:
+                    # nothing is kept while discarding, so everything received without a newline is part of the overlong line
+                    if newline < 0:
+                        fill = 0
+                        continue
+
+                    discarding = False
+                    start      = newline + 1
+                    newline    = rx_buffer.find(b"\n", start, end)
+
+                while newline >= 0:
+                    # printed as the raw bytes, so the line isn't decoded just for this
+                    if verbose:
+                        print(f"received message: {bytes(rx_view[start:newline])}")
+
+                    # the event id is the ascii digits before the first delimiter,
+                    # so it's parsed from the raw bytes and only the arguments after it get decoded
+                    delim = rx_buffer.find(delim_bytes, start, newline)
+                    head  = rx_buffer[start:newline if delim < 0 else delim]
+
+                    if head.isdigit():
+                        args = str(rx_view[delim + 1:newline], "ascii", "replace").split(delim_char) if delim >= 0 else []
+                        events.append((int(head), args))
+
+                    start   = newline + 1
+                    newline = rx_buffer.find(b"\n", start, end)
+
+                # move the unterminated remainder to the front of the buffer for the next recv_into
+                fill = end - start
+
+                if start and fill:
+                    rx_view[:fill] = rx_view[start:end]
+
+                if not events:
+                    continue
+
+                # only hold the mutex long enough to snapshot the callbacks for this batch,
+                # so a slow callback can't block set_event_hook
+                with self.__event_dict_mutex:
+                    event_dict = self.__event_dict.copy()
+
+                for event_id, args in events:
+                    # call the event hook for the received event_id
+                    hook = event_dict.get(event_id)
+
+                    if hook is None:
+                        continue
+
+                    callback, nargs = hook
+
+                    if nargs is None:
+                        # *args passes all message segments after the event id as arguments to the event's callback function
+                        callback(*args)
+                    elif len(args) < nargs:
+                        # the message is missing arguments the callback needs
+                        continue
+                    elif nargs == 1:
+                        callback(args[0])
+                    else:
+                        callback(*args[:nargs])
+        finally:
+            selector.unregister(connection)
+            self.__connected = False
+
+            if shutdown_requested:
+                connection.close()
 
-            segments = self.__parse_line(line)
+            # connect waits for this before starting a new read thread
+            self.__socket_read_stopped.set()
 
-            try:
-                event_id = int(segments[0])
-            except ValueError:
-                continue
+        # the DISCONNECTED event is only for connections that were lost, not ones closed on purpose
+        if shutdown_requested:
+            return
 
-            # call the event hook for the received event_id
-            if event_id in self.__event_dict and callable(self.__event_dict[event_id]):
-                # *segments[1:] passes all message segments after the first as arguments to the event's callback function
-                self.__event_dict_mutex.acquire()
-                self.__event_dict[event_id](*segments[1:])
-                self.__event_dict_mutex.release()
+        with self.__event_dict_mutex:
+            hook = self.__event_dict.get(TSPro.EVENT_CODES.DISCONNECTED)
 
-    def set_event_hook(self, event_id: int, callback: FunctionType):
+        if hook is not None:
+            callback, _ = hook
+            callback()
+
+    def set_event_hook(self, event_id: int, callback: Callable[..., None], nargs: int | None = None):
         """
         Set a callback function to be called when the specified event_id is received over the socket connection.
+
+        @param nargs int | None: how many of the message's arguments to pass to callback.
+            None passes all of them, however many were received.
+            A fixed count lets the socket read thread skip packing them, and messages with fewer arguments are ignored.
+        @raise TypeError: if callback is not callable
+        @raise ValueError: if nargs is negative
         """
 
+        # callbacks are only checked here, so the socket read thread can call them without checking each time
+        if not callable(callback):
+            raise TypeError(f"event hook for {event_id} must be callable, not {type(callback).__name__}")
+
+        if nargs is not None and nargs < 0:
+            raise ValueError(f"nargs must be None or a non-negative integer, not {nargs}")
+
         # __event_dict is modified in the main thread, separate from when it is accessed in the socket read thread.
         # this mutex to makes sure this process is thread-safe
-        self.__event_dict_mutex.acquire()
-        self.__event_dict[event_id] = callback
-        self.__event_dict_mutex.release()
+        with self.__event_dict_mutex:
+            self.__event_dict[event_id] = (callback, nargs)
 
     def remove_event_hook(self, event_id: int):
         """
@@ -184,9 +404,8 @@ class TSPro:
 
         # __event_dict is modified in the main thread, separate from when it is accessed in the socket read thread.
         # this mutex to makes sure this process is thread-safe
-        self.__event_dict_mutex.acquire()
-        del self.__event_dict[event_id]
-        self.__event_dict_mutex.release()
+        with self.__event_dict_mutex:
+            del self.__event_dict[event_id]
 
     def request_move_to_position(self, position: float):
         """
@@ -205,8 +424,7 @@ class TSPro:
         The sent message string is formatted like so: "stop\n"
         """
 
-        prefix = TSPro.MESSAGE_REQUEST_PREFIXES.STOP
-        self.__send_formatted_message(prefix)
+        self.__send_message(self.__stop_message)
 
     def request_current_position(self):
         """
@@ -215,8 +433,7 @@ class TSPro:
         The sent message string is formatted like so: "get_position\n"
         """
 
-        prefix = TSPro.MESSAGE_REQUEST_PREFIXES.GET_POSITION
-        self.__send_formatted_message(prefix)
+        self.__send_message(self.__get_position_message)
 
     def request_calibrate(self, position: float):
         """
@@ -234,8 +451,7 @@ class TSPro:
         The sent message string is formatted like so: "home\n",
         """
 
-        prefix = TSPro.MESSAGE_REQUEST_PREFIXES.HOME
-        self.__send_formatted_message(prefix)
+        self.__send_message(self.__home_message)
 
     def request_setting(self, setting_name: str):
         """
@@ -247,27 +463,79 @@ class TSPro:
         self.__send_formatted_message(prefix, setting_name)
 
     def request_cycle_tool(self):
-        prefix = TSPro.MESSAGE_REQUEST_PREFIXES.CYCLE_TOOL
-        self.__send_formatted_message(prefix)
+        self.__send_message(self.__cycle_tool_message)
 
     def connect(self, ip_address: str) -> bool:
         """
         Attempt to create a TCP socket connection to the provided ip ip_address
 
         @param ip_address str
-        @return bool: True on successful connection, False otherwise
+        @return bool: True on successful connection, False otherwise. Already being connected counts as success.
+            Called from an event hook after disconnect, this returns False,
+            since the hook's own socket read thread has to finish shutting down first.
         """
 
+        # the socket read thread is still using the current socket
+        if self.__connected:
+            return True
+
+        # a previous connection is still shutting down, and its read thread is still using the selector and rx buffer
+        if not self.__socket_read_stopped.is_set():
+            if threading.current_thread() is self.__socket_read_thread:
+                print("can't reconnect from an event hook until the previous connection has finished closing")
+                return False
+
+            self.__socket_read_stopped.wait()
+
+        # a socket can only be connected once, and a failed attempt can leave it unusable,
+        # so every attempt starts from a fresh socket instead of retrying on the old one
+        self.__socket.close()
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setblocking(True)
+
         try:
             self.__socket.connect((ip_address, PORT))
-            self.__socket_read_thread = threading.Thread(target = self.__socket_read, args = (self.__socket,))
-            self.__socket_read_thread.start()
+
+            # messages are small and latency-sensitive, so don't let Nagle's algorithm hold them back
+            self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # set before the thread starts, so a connection that drops immediately can't be marked connected afterward
             self.__connected = True
-        except socket.error as error:
+            self.__clear_shutdown_requests()
+            self.__socket_read_stopped.clear()
+            self.__selector.register(self.__socket, selectors.EVENT_READ)
+            self.__socket_read_thread = threading.Thread(target = self.__socket_read, args = (self.__socket,), daemon = True)
+            self.__socket_read_thread.start()
+        except OSError as error:
             print(error)
+            self.__socket.close()
             self.__connected = False
 
         return self.__connected
 
+    def disconnect(self):
+        """
+        Close the connection to the TigerStop and wait for the socket read thread to exit,
+        unless this is called from an event hook, in which case the thread exits once the hook returns.
+        The DISCONNECTED event hook is not called for a connection closed this way.
+        """
+
+        if not self.__socket_read_stopped.is_set():
+            # marked as closed right away, so a connect called before the read thread exits doesn't report the old connection
+            self.__connected = False
+
+            # the socket read thread closes its socket once it sees this byte
+            self.__shutdown_sender.send(b"\0")
+
+            # an event hook calling disconnect runs on the socket read thread, which can't wait for itself to exit.
+            # it stops after the hook returns and it gets back to waiting on the selector.
+            if threading.current_thread() is self.__socket_read_thread:
+                return
+
+            self.__socket_read_stopped.wait()
+
+        # the read thread only closes the socket when asked to shut down, so a connection that was lost is closed here
+        self.__socket.close()
+
     def is_connected(self) -> bool:
         return self.__connected